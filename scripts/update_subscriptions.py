@@ -4,42 +4,313 @@ import json
 import datetime
 import socket
 import concurrent.futures
+import threading
 from urllib.parse import urlparse, parse_qsl, urlunparse, urlencode
 import re
 import requests
 import time
-import pytz
+import random
+from zoneinfo import ZoneInfo
 import shutil
+import filecmp
+import struct
+import atexit
 from pathlib import Path
-from difflib import Differ
+from collections import deque, Counter
+from functools import lru_cache
+import ipaddress
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # === Server Remark and Flag Functions ===
 
+# Optional local GeoLite2 country database, consulted before the HTTP providers
+GEOIP_DB_FILE = os.getenv("GEOIP_DB_FILE", "GeoLite2-Country.mmdb")
+_MMDB = None
+
+def is_ip_address(value):
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+def is_unroutable_ip(value):
+    """True for IP literals no geolocation provider can place (private, loopback, link-local, reserved...)."""
+    try:
+        addr = ipaddress.ip_address(value)
+    except ValueError:
+        return False
+    return (addr.is_private or addr.is_loopback or addr.is_link_local or addr.is_reserved
+            or addr.is_multicast or addr.is_unspecified)
+
+def get_mmdb_reader():
+    """Open GEOIP_DB_FILE once. Returns None if maxminddb or the database is missing."""
+    global _MMDB
+    if _MMDB is None:
+        _MMDB = False
+        if maxminddb is not None and os.path.exists(GEOIP_DB_FILE):
+            try:
+                _MMDB = maxminddb.open_database(GEOIP_DB_FILE)
+            except Exception as e:
+                print(f"⚠️ Could not open {GEOIP_DB_FILE}: {str(e)}")
+    return _MMDB or None
+
+# URL-style server schemes (everything supported except base64-JSON vmess)
+URL_SCHEMES = ('vless://', 'trojan://', 'ss://', 'hysteria://', 'hysteria2://')
+
+# Plain (unescaped) "add" value of a vmess JSON payload
+_VMESS_ADD_RE = re.compile(r'"add"\s*:\s*"([^"\\]*)"')
+
 def extract_ip_from_server(server_line):
     """Extract IP address or hostname from server URL.
     Supports: vless, vmess, trojan, ss, hysteria, hysteria2"""
     try:
-        if server_line.startswith(('vless://', 'trojan://', 'hysteria://', 'hysteria2://')):
+        if server_line.startswith(URL_SCHEMES):
             parsed = urlparse(server_line.split('#')[0])
             return parsed.hostname
         elif server_line.startswith('vmess://'):
             base64_part = server_line[8:].split('#')[0]
             decoded = base64.b64decode(base64_part).decode('utf-8')
+            # Only the address is needed; parse the whole payload only for escaped values
+            match = _VMESS_ADD_RE.search(decoded)
+            if match:
+                return match.group(1)
             config = json.loads(decoded)
             return config.get('add')
-        elif server_line.startswith('ss://'):
-            parsed = urlparse(server_line.split('#')[0])
-            return parsed.hostname
         return None
     except Exception:
         return None
 
+def resolve_hosts(hosts, max_workers=32):
+    """Resolve hostnames to IP addresses in parallel.
+    Returns a dict host -> IP. IP literals and hostnames that fail to resolve map to themselves."""
+    def resolve(host):
+        if is_ip_address(host):
+            return host
+        try:
+            return socket.gethostbyname(host)
+        except OSError:
+            return host
+
+    unique_hosts = list(dict.fromkeys(h for h in hosts if h))
+    if not unique_hosts:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(unique_hosts, executor.map(resolve, unique_hosts)))
+
+# Attempts per geolocation provider before falling back to the next one
+PROVIDER_ATTEMPTS = 3
+# Request budget per provider: (calls, period in seconds)
+PROVIDER_RATE_LIMITS = {
+    'ipinfo.io': (40, 60),
+    'ip-api.com': (45, 60),
+    'ip-api.com/batch': (15, 60),
+}
+_provider_calls = {}
+# Lookups run from several threads; they share the request budget above
+_rate_limit_lock = threading.Lock()
+# Threads used for per-IP country lookups the batch endpoint could not answer
+GEO_LOOKUP_WORKERS = 16
+# Keep-alive HTTP session shared by all geolocation requests (and their threads)
+_GEO_SESSION = None
+_geo_session_lock = threading.Lock()
+
+def get_geo_session():
+    """Create the shared geolocation session on first use, sized for GEO_LOOKUP_WORKERS threads."""
+    global _GEO_SESSION
+    with _geo_session_lock:
+        if _GEO_SESSION is None:
+            session = requests.Session()
+            session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=GEO_LOOKUP_WORKERS))
+            session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=GEO_LOOKUP_WORKERS))
+            _GEO_SESSION = session
+    return _GEO_SESSION
+
+def wait_for_rate_limit(provider_name):
+    """Sleep only when the provider's request budget for the current period is used up.
+    The next free slot is reserved under the lock and waited for outside it, so a thread
+    waiting on one provider never holds up lookups against another."""
+    if provider_name not in PROVIDER_RATE_LIMITS:
+        return
+    calls, period = PROVIDER_RATE_LIMITS[provider_name]
+    with _rate_limit_lock:
+        history = _provider_calls.setdefault(provider_name, deque())
+        now = time.monotonic()
+        while history and now - history[0] >= period:
+            history.popleft()
+        # history may hold slots other threads reserved in the future; it stays sorted
+        slot = max(now, history[-calls] + period) if len(history) >= calls else now
+        history.append(slot)
+    if slot > now:
+        time.sleep(slot - now)
+
+def backoff_delay(attempt, response=None):
+    """Exponential backoff with jitter (1s, 2s, 4s ... up to 8s).
+    A numeric Retry-After header sent by the provider takes precedence."""
+    if response is not None:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(int(retry_after), 60)
+    return min(2 ** attempt, 8) + random.uniform(0, 1)
+
+# Country codes already looked up (IP or domain -> code)
+IP_COUNTRY_CACHE = {}
+# Country codes fetched from the network are kept here between runs
+IP_COUNTRY_CACHE_FILE = 'ip_country_cache.json'
+# Cached country codes older than this are looked up again (seconds)
+IP_COUNTRY_CACHE_TTL = 30 * 24 * 3600
+# At most this many entries are saved; the most recently looked-up ones are kept
+IP_COUNTRY_CACHE_MAX_ENTRIES = 10000
+# Lookup time of every cache entry that should be saved to IP_COUNTRY_CACHE_FILE
+_ip_cache_times = {}
+_ip_cache_dirty = False
+_ip_cache_loaded = False
+
+def load_ip_cache():
+    """Load IP_COUNTRY_CACHE_FILE into IP_COUNTRY_CACHE (once), skipping expired entries."""
+    global _ip_cache_loaded
+    if _ip_cache_loaded:
+        return
+    _ip_cache_loaded = True
+    if not os.path.exists(IP_COUNTRY_CACHE_FILE):
+        return
+    try:
+        with open(IP_COUNTRY_CACHE_FILE, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return
+    cutoff = time.time() - IP_COUNTRY_CACHE_TTL
+    for ip, entry in entries.items():
+        try:
+            cc, ts = entry['cc'], float(entry['ts'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if ts >= cutoff and cc:
+            IP_COUNTRY_CACHE.setdefault(ip, cc)
+            _ip_cache_times.setdefault(ip, ts)
+
+def save_ip_cache():
+    """Write network lookups back to IP_COUNTRY_CACHE_FILE if any were added this run.
+    Only the IP_COUNTRY_CACHE_MAX_ENTRIES most recent lookups are kept."""
+    global _ip_cache_dirty
+    if not _ip_cache_dirty:
+        return
+    if len(_ip_cache_times) > IP_COUNTRY_CACHE_MAX_ENTRIES:
+        newest = sorted(_ip_cache_times, key=_ip_cache_times.get, reverse=True)
+        for ip in newest[IP_COUNTRY_CACHE_MAX_ENTRIES:]:
+            del _ip_cache_times[ip]
+    entries = {ip: {"cc": IP_COUNTRY_CACHE[ip], "ts": int(ts)}
+               for ip, ts in sorted(_ip_cache_times.items()) if ip in IP_COUNTRY_CACHE}
+    write_file_atomic(IP_COUNTRY_CACHE_FILE, json.dumps(entries, indent=1))
+    _ip_cache_dirty = False
+
+def cache_country_code(ip, cc):
+    """Remember a country code fetched from the network so it is saved to disk."""
+    global _ip_cache_dirty
+    IP_COUNTRY_CACHE[ip] = cc
+    _ip_cache_times[ip] = time.time()
+    _ip_cache_dirty = True
+
+# Maximum number of queries ip-api.com accepts in one batch request
+IP_API_BATCH_SIZE = 100
+
+def lookup_mmdb_country(ip):
+    """Look up an IP literal in the local GeoLite2 database. Returns empty string if unavailable."""
+    if not is_ip_address(ip):
+        return ''
+    reader = get_mmdb_reader()
+    if reader is None:
+        return ''
+    try:
+        record = reader.get(ip) or {}
+    except ValueError:
+        return ''
+    cc = record.get('country', {}).get('iso_code', '')
+    return cc.upper() if cc and len(cc) == 2 else ''
+
+def get_country_codes_bulk(ips):
+    """Look up many IPs at once via ip-api.com's batch endpoint (100 queries per request).
+    Results are stored in IP_COUNTRY_CACHE; IPs that fail are left out.
+    Private and other unroutable addresses are cached as '' without a request."""
+    load_ip_cache()
+    pending = []
+    for ip in dict.fromkeys(ip for ip in ips if ip):
+        if ip in IP_COUNTRY_CACHE:
+            continue
+        if is_unroutable_ip(ip):
+            IP_COUNTRY_CACHE[ip] = ''
+            continue
+        cc = lookup_mmdb_country(ip)
+        if cc:
+            IP_COUNTRY_CACHE[ip] = cc
+        else:
+            pending.append(ip)
+
+    for start in range(0, len(pending), IP_API_BATCH_SIZE):
+        batch = pending[start:start + IP_API_BATCH_SIZE]
+        for attempt in range(PROVIDER_ATTEMPTS):
+            last_attempt = attempt == PROVIDER_ATTEMPTS - 1
+            try:
+                wait_for_rate_limit('ip-api.com/batch')
+                response = get_geo_session().post(
+                    'http://ip-api.com/batch?fields=countryCode,status,query',
+                    json=[{'query': ip} for ip in batch],
+                    timeout=15
+                )
+                if response.status_code == 429 or response.status_code >= 500:
+                    if not last_attempt:
+                        time.sleep(backoff_delay(attempt, response))
+                        continue
+                    break
+                if response.status_code == 200:
+                    for result in response.json():
+                        cc = result.get('countryCode', '')
+                        if result.get('status') == 'success' and result.get('query') and cc and len(cc) == 2:
+                            cache_country_code(result.get('query'), cc.upper())
+                break
+            except requests.exceptions.RequestException:
+                if not last_attempt:
+                    time.sleep(backoff_delay(attempt))
+                    continue
+                break
+            except Exception:
+                break
+
+    return {ip: IP_COUNTRY_CACHE[ip] for ip in ips if IP_COUNTRY_CACHE.get(ip)}
+
 def get_country_code(ip_or_domain):
     """Get country code for an IP address or domain name using multiple free APIs with fallback.
+    Answers from IP_COUNTRY_CACHE first, then the local GeoLite2 database (if installed).
     Tries providers in order: ipinfo.io (best limits), ip-api.com (backup).
     Returns empty string on failure."""
     if not ip_or_domain:
         return ''
+    load_ip_cache()
+    if ip_or_domain in IP_COUNTRY_CACHE:
+        return IP_COUNTRY_CACHE[ip_or_domain]
+    if is_unroutable_ip(ip_or_domain):
+        IP_COUNTRY_CACHE[ip_or_domain] = ''
+        return ''
+
+    # IP literals are answered from the local database when it is available
+    cc = lookup_mmdb_country(ip_or_domain)
+    if cc:
+        IP_COUNTRY_CACHE[ip_or_domain] = cc
+        return cc
     
     # Provider list with their API endpoints and response parsing
     providers = [
@@ -59,14 +330,16 @@ def get_country_code(ip_or_domain):
     
     # Try each provider
     for provider in providers:
-        for attempt in range(2):  # 2 attempts per provider
+        for attempt in range(PROVIDER_ATTEMPTS):
+            last_attempt = attempt == PROVIDER_ATTEMPTS - 1
             try:
-                response = requests.get(provider['url'], timeout=10)
+                wait_for_rate_limit(provider['name'])
+                response = get_geo_session().get(provider['url'], timeout=10)
                 
-                # Check for rate limiting
-                if response.status_code == 429:
-                    if attempt < 1:
-                        time.sleep(2)
+                # Rate limited or server error: back off and retry
+                if response.status_code == 429 or response.status_code >= 500:
+                    if not last_attempt:
+                        time.sleep(backoff_delay(attempt, response))
                         continue
                     # Try next provider
                     break
@@ -74,21 +347,16 @@ def get_country_code(ip_or_domain):
                 # Parse response
                 cc = provider['parse'](response)
                 if cc and len(cc) == 2:
+                    cache_country_code(ip_or_domain, cc.upper())
                     return cc.upper()
                 
-                # If successful response but no country code, don't retry
-                if response.status_code == 200:
-                    break
-                    
-            except requests.exceptions.Timeout:
-                if attempt < 1:
-                    time.sleep(1)
-                    continue
-                # Try next provider
+                # Any other answer won't change on retry
                 break
+                    
             except requests.exceptions.RequestException:
-                if attempt < 1:
-                    time.sleep(1)
+                # Timeouts and connection errors
+                if not last_attempt:
+                    time.sleep(backoff_delay(attempt))
                     continue
                 # Try next provider
                 break
@@ -98,30 +366,40 @@ def get_country_code(ip_or_domain):
     
     return ''
 
+# Flag emoji for every two-letter country code
+FLAG_TABLE = {f"{chr(65 + i)}{chr(65 + j)}": chr(0x1F1E6 + i) + chr(0x1F1E6 + j)
+              for i in range(26) for j in range(26)}
+
 def country_code_to_flag(country_code):
     if not country_code or len(country_code) != 2:
         return ''
-    try:
-        return chr(0x1F1E6 + ord(country_code[0].upper()) - ord('A')) + \
-               chr(0x1F1E6 + ord(country_code[1].upper()) - ord('A'))
-    except:
-        return ''
+    return FLAG_TABLE.get(country_code.upper(), '')
 
 def update_server_remarks(servers):
     """Update server remarks with flags. Flags may be missing if IP lookup fails.
-    Uses multiple free APIs with fallback: ipinfo.io (40k/month) -> ip-api.com (45/min).
-    Note: ipinfo.io has much better rate limits!"""
+    Country codes are fetched in bulk from ip-api.com's batch endpoint; anything it
+    misses falls back to the per-IP providers in get_country_code."""
     updated_servers = []
     failed_flags = 0
     failed_ips = []
-    
-    for idx, server in enumerate(servers, 1):
-        base_url = server.split('#')[0]
-        remark = server.split('#', 1)[1].strip() if '#' in server else ""
-        ip_or_domain = extract_ip_from_server(server)
+    load_ip_cache()
+
+    # Resolve all hostnames up front so the lookups below work on IP addresses
+    hosts = [extract_ip_from_server(server) for server in servers]
+    resolved_ips = resolve_hosts(hosts)
+    lookup_ips = [resolved_ips.get(host, host) for host in hosts if host]
+    get_country_codes_bulk(lookup_ips)
+    # Whatever the batch missed is looked up per IP, in parallel
+    missing = [ip for ip in dict.fromkeys(lookup_ips) if ip not in IP_COUNTRY_CACHE]
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=GEO_LOOKUP_WORKERS) as executor:
+            list(executor.map(get_country_code, missing))
+    
+    for idx, (server, ip_or_domain) in enumerate(zip(servers, hosts), 1):
+        base_url, _, remark = server.partition('#')
         
-        # Try to get country code and flag
-        cc = get_country_code(ip_or_domain)
+        # Country codes were all looked up above; failures are simply missing
+        cc = IP_COUNTRY_CACHE.get(resolved_ips.get(ip_or_domain, ip_or_domain), '')
         flag = country_code_to_flag(cc)
         
         # Track failures for reporting
@@ -131,7 +409,7 @@ def update_server_remarks(servers):
                 failed_ips.append(ip_or_domain)
         
         if "---" in remark:
-            _, custom = remark.split("---", 1)
+            custom = remark.partition("---")[2]
             new_remark = f"Server {idx} {flag}--- {custom.strip()}"
         else:
             new_remark = f"Server {idx} {flag}"
@@ -139,7 +417,7 @@ def update_server_remarks(servers):
         if server.startswith('vmess://'):
             try:
                 # VMess Logic: Decode -> Update 'ps' -> Encode
-                base64_part = server[8:].split('#')[0]
+                base64_part = base_url[8:]
                 # Fix Padding
                 missing_padding = len(base64_part) % 4
                 if missing_padding:
@@ -159,13 +437,9 @@ def update_server_remarks(servers):
                 updated_servers.append(f"vmess://{new_base64}")
             except Exception:
                 # Fallback if corrupt
-                updated_servers.append(f"{base_url}#{new_remark}")
+                updated_servers.append(f"{base_url}#{new_remark}".rstrip())
         else:
-            updated_servers.append(f"{base_url}#{new_remark}")
-        
-        # Rate limiting: ipinfo.io allows 40k/month, so we can be faster
-        # But still be safe to avoid hitting limits
-        time.sleep(0.5)  # Reduced delay since ipinfo.io has better limits
+            updated_servers.append(f"{base_url}#{new_remark}".rstrip())
     
     if failed_flags > 0:
         try:
@@ -175,17 +449,56 @@ def update_server_remarks(servers):
         except UnicodeEncodeError:
             print(f"Warning: Could not add flags to {failed_flags} servers (IP lookup failed)")
     
+    save_ip_cache()
     return updated_servers
 
 # === Enhanced User Management Functions ===
 
 USER_LIST_FILE = 'user_list.txt'
 BLOCKED_SYMBOL = '🚫'
-IRAN_TZ = pytz.timezone('Asia/Tehran')
+IRAN_TZ = ZoneInfo('Asia/Tehran')
+# Debug flag: DEBUG=1 makes the script print verbose diagnostics (full file/user lists, etc.)
+DEBUG = os.getenv("DEBUG", "0") == "1"
+# Matches any user-list command flag (---b, ---ub, ---d, ---m, ---r, ---es).
+# Compiled with google-re2 (linear-time DFA) when it is installed.
+_CMD_RE = (re2 or re).compile(r'---(?:ub|es|b|d|m|r)')
 
 # Last known state of user_list for detecting manual changes
 LAST_USER_STATE_FILE = 'last_user_state.json'
 
+def write_file_atomic(path, content):
+    """Write text (or bytes) to a temporary sibling file and swap it in with os.replace,
+    so a crash mid-write never leaves a truncated file behind."""
+    tmp_path = f"{path}.tmp"
+    if isinstance(content, bytes):
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+    os.replace(tmp_path, path)
+
+def read_stripped_lines(path):
+    """Return the stripped, non-empty lines of a UTF-8 text file, read in one call."""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = f.read()
+    # split('\n') rather than splitlines(), which would also break on
+    # Unicode separators that may appear inside server remarks
+    return [line for line in map(str.strip, data.split('\n')) if line]
+
+def write_file_if_changed(path, content):
+    """Atomically write bytes to path unless the file already holds exactly them.
+    Returns True if the file was written."""
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    return False
+    except FileNotFoundError:
+        pass
+    write_file_atomic(path, content)
+    return True
+
 def save_user_state(users=None):
     """Save current state of users for detecting manual changes later"""
     if users is None:
@@ -200,18 +513,32 @@ def save_user_state(users=None):
             state[username] = line
             usernames.append(username)
     
+    # Leave the file (and its timestamp) alone when no user line changed,
+    # so unchanged runs don't produce a new commit of the state file
+    try:
+        with open(LAST_USER_STATE_FILE, 'r', encoding='utf-8') as f:
+            last_state = json.load(f)
+        if last_state.get("usernames") == usernames and last_state.get("lines") == state:
+            return
+    except (OSError, ValueError, AttributeError):
+        pass
+    
     # Also save the order of usernames
     data = {
         "usernames": usernames,
         "lines": state,
-        "timestamp": get_iran_time().strftime("%Y-%m-%d %H:%M")
+        "timestamp": get_iran_timestamp()
     }
     
-    with open(LAST_USER_STATE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        content = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    else:
+        content = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    write_file_atomic(LAST_USER_STATE_FILE, content)
 
 def detect_manual_changes():
     """Detect manual changes to user_list.txt without command flags"""
+    reset_iran_time()
     if not os.path.exists(LAST_USER_STATE_FILE):
         # No previous state, just save current state
         save_user_state()
@@ -226,6 +553,8 @@ def detect_manual_changes():
     
     # Load current state
     current_users = load_user_list()
+    # Parse every line's username once; reused below instead of re-parsing
+    line_usernames = [extract_username_from_line(line) for line in current_users]
     current_usernames = set()
     current_lines = {}
     # Track manually modified users to create backups
@@ -233,16 +562,20 @@ def detect_manual_changes():
     # Track if any manual changes were made
     any_manual_changes = False
     
-    for line in current_users:
+    for username, line in zip(line_usernames, current_users):
         # Skip processing lines with command flags, as these will be handled elsewhere
-        if any(cmd in line for cmd in ['---b', '---ub', '---d', '---m', '---r', '---es']):
+        if _CMD_RE.search(line):
             continue
             
-        username = extract_username_from_line(line)
         if username:
             current_usernames.add(username)
             current_lines[username] = line
     
+    # Nothing was edited by hand: one dict comparison instead of the per-user checks below
+    if current_lines == last_lines:
+        save_user_state(current_users)
+        return
+    
     # Find manually deleted users
     deleted = last_usernames - current_usernames
     if deleted:
@@ -290,16 +623,12 @@ def detect_manual_changes():
                     # Update the in-memory representations of the user list
                     current_lines[username] = cleaned_line
                     # Find the index and update the list itself
-                    for i, line in enumerate(current_users):
-                        if extract_username_from_line(line) == username:
-                            current_users[i] = cleaned_line
-                            break
+                    current_users[line_usernames.index(username)] = cleaned_line
                     new_line = cleaned_line # Use the cleaned line for the diff
 
-            # Use difflib to find exact changes
-            differ = Differ()
-            diff = list(differ.compare([last_lines[username]], [new_line]))
-            diff_text = '\n'.join(diff)
+            # Single line before/after; no need for a full difflib comparison
+            old_line = last_lines[username]
+            diff_text = f"  {new_line}" if old_line == new_line else f"- {old_line}\n+ {new_line}"
             details = f"Changes:\n{diff_text}"
             log_user_history(username, "manual_change", details)
             manual_modified_users.add(username)
@@ -309,55 +638,68 @@ def detect_manual_changes():
         backup_user_list()
         
     # Backup all manually modified users
-    for username in manual_modified_users:
-        backup_user(username)
+    backup_users(manual_modified_users)
     
     # Move manually modified users to the top of the list
     if manual_modified_users:
-        final_users = current_users.copy()
-        for username in manual_modified_users:
-            final_users = move_user_to_top(final_users, username)
-        save_user_list(final_users)
+        final_users = move_users_to_top(current_users, manual_modified_users)
+        # The full backup was already taken above
+        save_user_list(final_users, backup=False)
     
     # Save new state for next comparison
     save_user_state(current_users)
 
+# Time snapshot shared by everything an entry point calls (see reset_iran_time)
+_TIME_CACHE = None
+
 def get_iran_time():
-    utc_now = datetime.datetime.now(pytz.UTC)
+    if _TIME_CACHE is not None:
+        return _TIME_CACHE
+    utc_now = datetime.datetime.now(datetime.timezone.utc)
     return utc_now.astimezone(IRAN_TZ)
 
+def reset_iran_time():
+    """Take a fresh time snapshot; get_iran_time() returns it until the next reset."""
+    global _TIME_CACHE
+    _TIME_CACHE = None
+    _TIME_CACHE = get_iran_time()
+
+# (snapshot, "YYYY-MM-DD HH:MM") so history entries don't re-format the same time
+_TIMESTAMP_CACHE = (None, '')
+
+def get_iran_timestamp():
+    """get_iran_time() formatted as "YYYY-MM-DD HH:MM", formatted once per snapshot."""
+    global _TIMESTAMP_CACHE
+    now = get_iran_time()
+    if _TIMESTAMP_CACHE[0] is not now:
+        _TIMESTAMP_CACHE = (now, now.strftime("%Y-%m-%d %H:%M"))
+    return _TIMESTAMP_CACHE[1]
+
 def load_user_list():
-    if not os.path.exists(USER_LIST_FILE):
+    try:
+        return read_stripped_lines(USER_LIST_FILE)
+    except FileNotFoundError:
         return []
-    with open(USER_LIST_FILE, 'r', encoding='utf-8') as f:
-        return [line.strip() for line in f if line.strip()]
 
-def save_user_list(users):
-    # Create backup before saving changes
-    backup_user_list()
+def save_user_list(users, backup=True):
+    # Create backup before saving changes, unless the caller already did
+    if backup:
+        backup_user_list()
 
-    with open(USER_LIST_FILE, 'w', encoding='utf-8') as f:
-        if users:
-            f.write('\n'.join(users) + '\n')
+    content = '\n'.join(users) + '\n' if users else ''
+    write_file_if_changed(USER_LIST_FILE, content.encode('utf-8'))
 
+# Cached: the same lines are parsed by many passes over the user list in one run
+@lru_cache(maxsize=4096)
 def extract_username_from_line(user_line):
-    # First remove the blocked symbol if present
-    clean_line = user_line.replace(BLOCKED_SYMBOL, '').strip()
-    
-    # Handle notes by removing everything after #
-    if '#' in clean_line:
-        clean_line = clean_line.split('#')[0].strip()
-    
-    # Handle command flags
-    if '---' in clean_line:
-        before_command = clean_line.split('---')[0].strip()
-        username = before_command.split()[0] if before_command.split() else ''
-        return username
-    else:
-        # Just get the first word as username
-        username = clean_line.split()[0] if clean_line.split() else clean_line
-        return username
-
+    # Drop the blocked symbol, then notes (after #) and command flags (after ---)
+    clean_line = user_line.replace(BLOCKED_SYMBOL, '')
+    clean_line = clean_line.partition('#')[0].partition('---')[0]
+    # The username is the first remaining word
+    words = clean_line.split(None, 1)
+    return words[0] if words else ''
+
+@lru_cache(maxsize=4096)
 def extract_user_data_from_line(user_line):
     clean_line = user_line.replace(BLOCKED_SYMBOL, '').strip()
 
@@ -392,43 +734,46 @@ def remove_notes_from_line(user_line):
     return user_line.strip()
 
 # === Helper to remove prior block-date tags ===
+# Optional whitespace, a pipe, the word 'blocked' and a date
+_BLOCK_DATE_RE = re.compile(r"\s*\|\s*blocked\s+\d{4}-\d{2}-\d{2}")
+
 def strip_block_dates(note: str) -> str:
     """Remove all occurrences of "| blocked YYYY-MM-DD" from a note string."""
     if not note:
         return note
-    # Regex matches optional whitespace, a pipe, the word 'blocked' and a date.
-    cleaned = re.sub(r"\s*\|\s*blocked\s+\d{4}-\d{2}-\d{2}", "", note)
+    cleaned = _BLOCK_DATE_RE.sub("", note)
     return cleaned.strip()
 
+# Relative expiry formats accepted by ---es, tried in order ("14:30", "3d 10:00", "2w", "1m", "12h", ...)
+_RELATIVE_PATTERNS = tuple(re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'^(\d{1,2}):(\d{1,2})$',
+    r'(\d+)\s*(days?|d)\s+(\d{1,2}):(\d{1,2})',
+    r'(\d+)\s*(days?|d)$',
+    r'(\d+)\s*(weeks?|w)\s+(\d{1,2}):(\d{1,2})',
+    r'(\d+)\s*(weeks?|w)$',
+    r'(\d+)\s*(months?|m)\s+(\d{1,2}):(\d{2})',
+    r'(\d+)\s*(months?|m)$',
+    r'(\d+)\s*(hours?|h)$',
+))
+
 def parse_relative_datetime(relative_str):
     if not relative_str:
         return None
     now = get_iran_time()
     today = now.date()
-    patterns = [
-        r'^(\d{1,2}):(\d{1,2})$',
-        r'(\d+)\s*(days?|d)\s+(\d{1,2}):(\d{1,2})',
-        r'(\d+)\s*(days?|d)$',
-        r'(\d+)\s*(weeks?|w)\s+(\d{1,2}):(\d{1,2})',
-        r'(\d+)\s*(weeks?|w)$',
-        r'(\d+)\s*(months?|m)\s+(\d{1,2}):(\d{2})',
-        r'(\d+)\s*(months?|m)$',
-        r'(\d+)\s*(hours?|h)$',
-    ]
-    for i, pattern in enumerate(patterns):
-        match = re.match(pattern, relative_str.strip(), re.IGNORECASE)
+    relative_str = relative_str.strip()
+    for i, pattern in enumerate(_RELATIVE_PATTERNS):
+        match = pattern.match(relative_str)
         if match:
             groups = match.groups()
             if i == 0:
                 hour, minute = int(groups[0]), int(groups[1])
                 if 0 <= hour <= 23 and 0 <= minute <= 59:
                     target_time = datetime.time(hour, minute)
-                    naive_dt = datetime.datetime.combine(today, target_time)
-                    target_datetime = IRAN_TZ.localize(naive_dt)
+                    target_datetime = datetime.datetime.combine(today, target_time, tzinfo=IRAN_TZ)
                     if target_datetime <= now:
                         tomorrow = today + datetime.timedelta(days=1)
-                        naive_dt = datetime.datetime.combine(tomorrow, target_time)
-                        target_datetime = IRAN_TZ.localize(naive_dt)
+                        target_datetime = datetime.datetime.combine(tomorrow, target_time, tzinfo=IRAN_TZ)
                     return target_datetime
                 else:
                     return None
@@ -452,10 +797,7 @@ def parse_relative_datetime(relative_str):
                 else:
                     hour, minute = 23, 59
                 target_date = (now + delta).date()
-                target_time = datetime.time(hour, minute)
-                naive_dt = datetime.datetime.combine(target_date, target_time)
-                target_datetime = IRAN_TZ.localize(naive_dt)
-                return target_datetime
+                return datetime.datetime.combine(target_date, datetime.time(hour, minute), tzinfo=IRAN_TZ)
     return None
 
 def format_expiry_datetime(target_datetime):
@@ -467,14 +809,19 @@ def format_expiry_datetime(target_datetime):
     else:
         return f"{target_datetime.strftime('%Y-%m-%d %H:%M')} expires"
 
+# Expiry stamps written by format_expiry_datetime
+_EXPIRY_PATTERNS = (
+    re.compile(r'(\d{4}-\d{2}-\d{2} \d{1,2}:\d{2}) expires'),
+    re.compile(r'(\d{1,2}:\d{2}) expires today'),
+)
+
 def check_expiry_datetime(user_line):
+    # Most lines carry no expiry stamp at all
+    if 'expires' not in user_line:
+        return False, None
     now = get_iran_time()
-    datetime_patterns = [
-        r'(\d{4}-\d{2}-\d{2} \d{1,2}:\d{2}) expires',
-        r'(\d{1,2}:\d{2}) expires today'
-    ]
-    for pattern in datetime_patterns:
-        match = re.search(pattern, user_line)
+    for pattern in _EXPIRY_PATTERNS:
+        match = pattern.search(user_line)
         if match:
             datetime_str = match.group(1)
             try:
@@ -483,13 +830,11 @@ def check_expiry_datetime(user_line):
                     hour, minute = map(int, time_part.split(':'))
                     if not (0 <= hour <= 23 and 0 <= minute <= 59):
                         continue
-                    today = now.date()
-                    target_time = datetime.time(hour, minute)
-                    naive_dt = datetime.datetime.combine(today, target_time)
-                    target_datetime = IRAN_TZ.localize(naive_dt)
+                    target_datetime = datetime.datetime.combine(
+                        now.date(), datetime.time(hour, minute), tzinfo=IRAN_TZ)
                 else:
                     target_datetime = datetime.datetime.strptime(datetime_str, '%Y-%m-%d %H:%M')
-                    target_datetime = IRAN_TZ.localize(target_datetime)
+                    target_datetime = target_datetime.replace(tzinfo=IRAN_TZ)
                 if target_datetime <= now:
                     return True, target_datetime
             except Exception:
@@ -502,7 +847,7 @@ def generate_unique_username(base_username):
     For example, if 'ahmad' exists, it will try 'ahmad1', 'ahmad2', etc.
     """
     users = load_user_list()
-    existing_usernames = [extract_username_from_line(user) for user in users]
+    existing_usernames = {extract_username_from_line(user) for user in users}
     
     # Check if the base username is already unique
     if base_username not in existing_usernames:
@@ -519,11 +864,11 @@ def generate_unique_username(base_username):
 def add_user_to_list(username, user_data=''):
     users = load_user_list()
     # Extract just the usernames for comparison
-    existing_usernames = [extract_username_from_line(user) for user in users]
+    existing_usernames = {extract_username_from_line(user) for user in users}
     
-    # Debug print to help identify the issue
     print(f"Adding user via add_user_to_list: {username}")
-    print(f"Existing usernames: {existing_usernames}")
+    if DEBUG:
+        print(f"Existing usernames: {sorted(existing_usernames)}")
     
     original_username = username
     # Clean the username from any notes or commands before comparison
@@ -539,12 +884,9 @@ def add_user_to_list(username, user_data=''):
         print(f"⚠️ Username {original_username} already exists, using {username} instead")
     
     new_entry = f"{username} {user_data}" if user_data else username
-    # Add the new user to the list
-    users.append(new_entry)
-    # Move the new user to the top
-    users = move_user_to_top(users, username)
-    # Create a full backup when adding a new user
-    backup_user_list()
+    # Add the new user at the top of the list
+    users.insert(0, new_entry)
+    # save_user_list creates the full backup
     save_user_list(users)
     # Create individual backup for this new user
     backup_user(username)
@@ -560,23 +902,23 @@ def add_user_to_list(username, user_data=''):
 
 def create_subscription_file(username):
     subscription_dir = 'subscriptions'
-    if not os.path.exists(subscription_dir):
-        os.makedirs(subscription_dir)
+    os.makedirs(subscription_dir, exist_ok=True)
     sub_file = os.path.join(subscription_dir, f"{username}.txt")
-    if not os.path.exists(sub_file):
-        with open(sub_file, 'w', encoding='utf-8') as f:
-            f.write('')
-        try:
-            print(f"📄 Created subscription file: {username}.txt")
-        except UnicodeEncodeError:
-            print(f"[OK] Created subscription file: {username}.txt")
-        return True
-    else:
+    # Exclusive create: one open() call both checks for and creates the file
+    try:
+        with open(sub_file, 'x', encoding='utf-8'):
+            pass
+    except FileExistsError:
         try:
             print(f"⚠️  Subscription file already exists: {username}.txt")
         except UnicodeEncodeError:
             print(f"[WARN] Subscription file already exists: {username}.txt")
         return False
+    try:
+        print(f"📄 Created subscription file: {username}.txt")
+    except UnicodeEncodeError:
+        print(f"[OK] Created subscription file: {username}.txt")
+    return True
 
 def rename_subscription_file(old_username, new_username):
     subscription_dir = 'subscriptions'
@@ -608,26 +950,34 @@ def rename_subscription_file(old_username, new_username):
             print(f"[WARN] Subscription file not found: {old_username}.txt")
         return new_username  # Return the original username
 
-def move_user_to_top(users, username):
-    """Move a user to the top of the user list."""
-    user_line = None
-    remaining_users = []
-    
-    # Find the user's line and collect all other users
+def move_users_to_top(users, usernames):
+    """Move every user in the set `usernames` to the top of the user list in one pass.
+
+    Only the last line of each moved user is kept; moved users keep their order in `users`.
+    """
+    top = {}
+    rest = []
     for line in users:
-        if extract_username_from_line(line) == username:
-            user_line = line
+        username = extract_username_from_line(line)
+        if username in usernames:
+            top[username] = line
         else:
-            remaining_users.append(line)
-    
-    # If user was found, add them to the top
-    if user_line:
-        return [user_line] + remaining_users
-    
-    # If user wasn't found, return original list
-    return users
+            rest.append(line)
+    return list(top.values()) + rest
+
+def write_blocked_users_file(users, first=()):
+    """Rewrite blocked_users.txt from the blocked lines of `users`, keeping notes.
+    Users in `first` are listed first, the rest in their order in `users`."""
+    # Entries include pipe notes if present
+    blocked_entries = (line[len(BLOCKED_SYMBOL):].lstrip() for line in users if line.startswith(BLOCKED_SYMBOL))
+    blocked_lines_dict = {extract_username_from_line(entry): entry for entry in blocked_entries}
+    ordered_blocked = [blocked_lines_dict.pop(uname) for uname in first if uname in blocked_lines_dict]
+    ordered_blocked.extend(blocked_lines_dict.values())
+    with open('blocked_users.txt', 'w', encoding='utf-8') as f:
+        f.write(''.join(f"{entry}\n" for entry in ordered_blocked))
 
 def process_user_commands():
+    reset_iran_time()
     users = load_user_list()
 
     # --- Pre-clean: remove stale "| blocked" notes from any un-blocked user ---
@@ -660,21 +1010,32 @@ def process_user_commands():
     renamed_users = {}
     # Track modified users to create backups
     modified_users = set()
-    # Track if any commands were processed
-    any_commands_processed = False
     # Track users that need to be moved to the top
     users_to_top = set()
     
-    for user_line in users:
-        if '---b' in user_line:
-            any_commands_processed = True
-            username = extract_username_from_line(user_line)
+    # Parse each line's username once; every branch below reuses it
+    parsed = [(line, extract_username_from_line(line)) for line in users]
+    # Usernames of the original list (with counts), of updated_users so far and
+    # of rename targets, kept current so duplicate checks never rescan the lists
+    existing_username_counts = Counter(username for _, username in parsed)
+    updated_usernames = set()
+    renamed_new_usernames = set()
+
+    def add_updated_line(line):
+        updated_users.append(line)
+        updated_usernames.add(extract_username_from_line(line))
+    
+    for user_line, line_username in parsed:
+        # Find every command token in one scan; the branch order below sets precedence
+        commands = set(_CMD_RE.findall(user_line))
+        if '---b' in commands:
+            username = line_username
             # Remove any existing command tokens and pipe-notes before extracting user_data
             cleaned_line = user_line.split('---')[0].split('|')[0].strip()
             user_data = extract_user_data_from_line(cleaned_line)
             raw_notes = extract_notes_from_line(user_line)
             # Remove command flags from notes
-            notes = raw_notes.replace('---b', '').replace('---ub', '').replace('---d', '').replace('---r', '').replace('---m', '').replace('---es', '').strip()
+            notes = _CMD_RE.sub('', raw_notes).strip()
             # Clean up any double spaces
             notes = ' '.join(notes.split())
             blocked_users.add(username)
@@ -704,16 +1065,15 @@ def process_user_commands():
                 updated_line = f"{BLOCKED_SYMBOL}{username} {notes_with_hash}"
             else:
                 updated_line = f"{BLOCKED_SYMBOL}{username}"
-            updated_users.append(updated_line)
-        elif '---ub' in user_line:
-            any_commands_processed = True
-            username = extract_username_from_line(user_line)
+            add_updated_line(updated_line)
+        elif '---ub' in commands:
+            username = line_username
             user_data = extract_user_data_from_line(user_line)
             # Clean any old block-date tags from the note when unblocking
             raw_notes = extract_notes_from_line(user_line)
             notes = strip_block_dates(raw_notes)
             # Remove command flags from notes if they're there
-            notes = notes.replace('---ub', '').replace('---ub', '').strip()
+            notes = _CMD_RE.sub('', notes).strip()
             # Clean up any double spaces
             notes = ' '.join(notes.split())
             unblocked_users.add(username)
@@ -730,22 +1090,16 @@ def process_user_commands():
                 updated_line = f"{username} #{notes}"
             else:
                 updated_line = username
-            updated_users.append(updated_line)
-        elif '---d' in user_line:
-            any_commands_processed = True
-            username = extract_username_from_line(user_line)
+            add_updated_line(updated_line)
+        elif '---d' in commands:
+            username = line_username
             deleted_users.add(username)
             log_user_history(username, "removed", "User deleted")
-        elif '---m' in user_line:
-            any_commands_processed = True
+        elif '---m' in commands:
             # Extract everything after ---m but before # (for notes)
-            command_part = user_line.split('---m')[1]
-            if '#' in command_part:
-                notes_part = command_part.split('#')[1]
-                data_part = command_part.split('#')[0].strip()
-            else:
-                notes_part = ''
-                data_part = command_part.strip()
+            command_part = user_line.partition('---m')[2]
+            data_part, _, notes_part = command_part.partition('#')
+            data_part = data_part.strip()
             
             # If there's data after ---m, treat first word as username, rest as user_data
             if data_part:
@@ -754,12 +1108,12 @@ def process_user_commands():
                 user_data = ' '.join(parts[1:]) if len(parts) > 1 else ''
             else:
                 # No data after ---m, extract from before command (in case format is "username ---m")
-                username = extract_username_from_line(user_line)
+                username = line_username
                 user_data = extract_user_data_from_line(user_line)
             
             raw_notes = notes_part.strip()
             # Remove command flags from notes if they somehow got there
-            notes = raw_notes.replace('---m', '').replace('---b', '').replace('---ub', '').replace('---d', '').replace('---r', '').replace('---es', '').strip()
+            notes = _CMD_RE.sub('', raw_notes).strip()
             # Clean up any double spaces
             notes = ' '.join(notes.split())
             
@@ -774,14 +1128,10 @@ def process_user_commands():
             # Check if username already exists and generate a unique one if needed
             original_username = username
             # Exclude the current line from duplicate check to avoid false positives
-            existing_usernames = [extract_username_from_line(u) for u in users if u is not user_line]
-            existing_updated_usernames = [extract_username_from_line(u) for u in updated_users]
-            # Also check against any new usernames from renames that happened earlier in this batch
-            renamed_new_usernames = set(renamed_users.values())
-            # Also check against new_users that were already added in this batch
-            existing_new_usernames = new_users.copy()
+            in_other_lines = existing_username_counts[username] - (line_username == username) > 0
             
-            if username in existing_updated_usernames or username in existing_usernames or username in renamed_new_usernames or username in existing_new_usernames:
+            # Also check new names from earlier renames and users already added in this batch
+            if username in updated_usernames or in_other_lines or username in renamed_new_usernames or username in new_users:
                 username = generate_unique_username(username)
                 log_user_history(username, "auto_renamed", f"Automatically renamed from {original_username} due to duplicate")
                 try:
@@ -792,7 +1142,7 @@ def process_user_commands():
             new_users.add(username)
             details = user_data if user_data else ""
             # Let log_user_history handle adding the note
-            log_user_history(username, "added", details)
+            log_user_history(username, "added", details, notes=notes)
             
             # Create subscription file
             create_subscription_file(username)
@@ -806,49 +1156,45 @@ def process_user_commands():
                 updated_line = f"{username} #{notes}"
             else:
                 updated_line = username
-            updated_users.append(updated_line)
+            add_updated_line(updated_line)
             
             # Add to users_to_top to ensure it's moved to the top
             users_to_top.add(username)
-        elif '---r' in user_line:
-            any_commands_processed = True
-            old_username = extract_username_from_line(user_line)
+        elif '---r' in commands:
+            old_username = line_username
             user_data = extract_user_data_from_line(user_line)
             notes = extract_notes_from_line(user_line)
-            command_part = user_line.split('---r')[1]
-            if '#' in command_part:
-                command_part = command_part.split('#')[0]
+            command_part = user_line.partition('---r')[2].partition('#')[0]
             new_username = command_part.strip().split()[0] if command_part.strip() else ''
             # Remove command from notes if it's there
             if notes and '---r' in notes:
-                notes = notes.split('---r')[0].strip()
+                notes = notes.partition('---r')[0].strip()
             # Clean up any double spaces in notes
             notes = ' '.join(notes.split())
             if new_username and new_username != old_username:
                 # Check if target username already exists (in original list, updated list, renamed in this batch, or new users in this batch)
-                existing_usernames = [extract_username_from_line(u) for u in users]
-                existing_updated_usernames = [extract_username_from_line(u) for u in updated_users]
-                renamed_new_usernames = set(renamed_users.values())
                 # Also check if this user was already renamed in this batch (old_username might be a new name from earlier rename)
-                if old_username in renamed_users.values():
+                if old_username in renamed_new_usernames:
                     # This user was already renamed, skip this rename
-                    updated_users.append(user_line)
+                    add_updated_line(user_line)
                     continue
                 
                 # If target username conflicts, generate a unique one
-                if new_username in existing_usernames or new_username in existing_updated_usernames or new_username in renamed_new_usernames or new_username in new_users:
+                if new_username in existing_username_counts or new_username in updated_usernames or new_username in renamed_new_usernames or new_username in new_users:
                     original_new_username = new_username
                     new_username = generate_unique_username(new_username)
-                    log_user_history(old_username, "rename_target_conflict", f"Target username {original_new_username} already exists, using {new_username} instead")
+                    log_user_history(old_username, "rename_target_conflict", f"Target username {original_new_username} already exists, using {new_username} instead", notes=notes)
                     try:
                         print(f"⚠️ Rename target {original_new_username} already exists, using {new_username} instead")
                     except UnicodeEncodeError:
                         print(f"[WARN] Rename target {original_new_username} already exists, using {new_username} instead")
+                renamed_new_usernames.discard(renamed_users.get(old_username))
                 renamed_users[old_username] = new_username
+                renamed_new_usernames.add(new_username)
                 modified_users.add(old_username)
                 users_to_top.add(new_username)  # Move to top when renamed
                 # Will backup the new username after processing
-                log_user_history(old_username, "renamed", f"to {new_username}")
+                log_user_history(old_username, "renamed", f"to {new_username}", notes=notes)
                 symbol = BLOCKED_SYMBOL if user_line.startswith(BLOCKED_SYMBOL) else ''
                 
                 # Rename subscription file - this might return a different username if there's a conflict
@@ -856,8 +1202,10 @@ def process_user_commands():
                 
                 # If the username was changed due to a conflict, update our tracking
                 if actual_new_username != new_username:
+                    renamed_new_usernames.discard(new_username)
                     new_username = actual_new_username
                     renamed_users[old_username] = new_username
+                    renamed_new_usernames.add(new_username)
                     users_to_top.add(new_username)
                 
                 if user_data and notes:
@@ -868,34 +1216,29 @@ def process_user_commands():
                     updated_line = f"{symbol}{new_username} #{notes}"
                 else:
                     updated_line = f"{symbol}{new_username}"
-                updated_users.append(updated_line)
+                add_updated_line(updated_line)
             else:
-                updated_users.append(user_line)
-        elif '---es' in user_line:
-            any_commands_processed = True
-            username = extract_username_from_line(user_line)
+                add_updated_line(user_line)
+        elif '---es' in commands:
+            username = line_username
             notes = extract_notes_from_line(user_line)
             modified_users.add(username)
             users_to_top.add(username)  # Move to top when expiry is set
-            parts = user_line.split('---es')
-            if len(parts) > 1:
-                time_part = parts[1]
-                if '#' in time_part:
-                    time_part = time_part.split('#')[0]
-                time_part = time_part.strip()
-                user_data_before = parts[0].replace(BLOCKED_SYMBOL, '').strip()
+            user_data_before, sep, time_part = user_line.partition('---es')
+            if sep:
+                time_part = time_part.partition('#')[0].strip()
+                user_data_before = user_data_before.replace(BLOCKED_SYMBOL, '').strip()
                 user_data_parts = user_data_before.split()
                 if user_data_parts:
                     user_data_parts.pop(0)
                     existing_data = ' '.join(user_data_parts)
-                    if '#' in existing_data:
-                        existing_data = existing_data.split('#')[0].strip()
+                    existing_data = existing_data.partition('#')[0].strip()
                 else:
                     existing_data = ''
                 target_datetime = parse_relative_datetime(time_part)
                 if target_datetime:
                     formatted_expiry = format_expiry_datetime(target_datetime)
-                    log_user_history(username, "expiry_set", f"{formatted_expiry}")
+                    log_user_history(username, "expiry_set", f"{formatted_expiry}", notes=notes)
                     symbol = BLOCKED_SYMBOL if user_line.startswith(BLOCKED_SYMBOL) else ''
                     if existing_data and notes:
                         updated_line = f"{symbol}{username} {formatted_expiry} {existing_data} #{notes}"
@@ -905,80 +1248,40 @@ def process_user_commands():
                         updated_line = f"{symbol}{username} {formatted_expiry} #{notes}"
                     else:
                         updated_line = f"{symbol}{username} {formatted_expiry}"
-                    updated_users.append(updated_line)
+                    add_updated_line(updated_line)
                 else:
-                    updated_users.append(user_line)
+                    add_updated_line(user_line)
             else:
-                updated_users.append(user_line)
+                add_updated_line(user_line)
         else:
             # Default: keep line as-is
-            updated_users.append(user_line)
+            add_updated_line(user_line)
     
-    # Move modified users to the top (in reverse order to maintain priority)
-    # We process in reverse order so that the first user to be moved to the top
-    # will end up at the very top
-    final_users = updated_users.copy()
-    for username in users_to_top:
-        final_users = move_user_to_top(final_users, username)
+    # Move modified users to the top, keeping their relative order
+    final_users = move_users_to_top(updated_users, users_to_top)
     
     # after processing all commands
     # Save new state after command processing
     save_user_state(final_users)
     
-    # Create a backup if any commands were processed
-    if any_commands_processed:
-        backup_user_list()
-    
     save_user_list(final_users)
     
     # Create individual backups for each modified user
-    for username in modified_users:
-        backup_user(username)
+    backup_users(modified_users)
     
     # Also backup new usernames from renamed users
-    for old_username, new_username in renamed_users.items():
-        backup_user(new_username)
+    backup_users(renamed_users.values())
 
     # --- Rebuild blocked_users.txt with notes (including block date) ---
-    # First, collect blocked lines from final_users
-    blocked_lines_dict = {}
-    for line in final_users:
-        if line.startswith(BLOCKED_SYMBOL):
-            entry = line.lstrip(BLOCKED_SYMBOL).lstrip()
-            uname = extract_username_from_line(entry)
-            blocked_lines_dict[uname] = entry  # includes pipe note if present
-
-    # Order: freshly blocked first (keep users order in `blocked_users` set), then remaining
-    ordered_blocked = []
-    for uname in blocked_users:
-        if uname in blocked_lines_dict:
-            ordered_blocked.append(blocked_lines_dict.pop(uname))
-    # Append the rest preserving their appearance order in final_users
-    for entry in blocked_lines_dict.values():
-        ordered_blocked.append(entry)
-
-    with open('blocked_users.txt', 'w', encoding='utf-8') as f:
-        for entry in ordered_blocked:
-            f.write(f"{entry}\n")
+    # Unblocked and deleted users are already gone from final_users
+    write_blocked_users_file(final_users, blocked_users)
 
-    existing_blocked = get_blocked_users()
-    if blocked_users:
-        all_blocked = existing_blocked.union(blocked_users)
-    else:
-        all_blocked = existing_blocked
-    if unblocked_users:
-        all_blocked = all_blocked - unblocked_users
-    if deleted_users:
-        all_blocked = all_blocked - deleted_users
-    # We already wrote the full blocked lines (including notes) earlier. Do not
-    # overwrite them with username-only lines.  If we need to ensure order, we
-    # could rebuild the list including notes, but for now we keep the first
-    # write intact to preserve information.
     subscription_dir = 'subscriptions'
     for username in deleted_users:
-        sub_file = os.path.join(subscription_dir, f"{username}.txt")
-        if os.path.exists(sub_file):
-            os.remove(sub_file)
+        try:
+            os.remove(os.path.join(subscription_dir, f"{username}.txt"))
+        except FileNotFoundError:
+            pass
 
 # === BLOCKED USERS FILE COMMANDS ===
 
@@ -990,6 +1293,7 @@ def process_blocked_users_commands():
     Note: ---b (block) command is NOT supported here. Use user_list.txt with ---b instead.
     This file is a shortcut for finding blocked users and unblocking/deleting easily.
     """
+    reset_iran_time()
     blocked_file = 'blocked_users.txt'
     if not os.path.exists(blocked_file):
         return  # nothing to do
@@ -1001,21 +1305,13 @@ def process_blocked_users_commands():
     dedup_dict = {}
     for ln in raw_lines_original:
         uname = extract_username_from_line(ln)
-        if uname in dedup_dict:
-            # Prefer the line that has a '|' annotation (more information)
-            if '|' in ln and '|' not in dedup_dict[uname]:
-                dedup_dict[uname] = ln
-        else:
+        current = dedup_dict.get(uname)
+        # Keep the first line unless a later one has a '|' annotation (more information)
+        if current is None or ('|' in ln and '|' not in current):
             dedup_dict[uname] = ln
 
     raw_lines = list(dedup_dict.values())
 
-    # If duplicates were removed, rewrite the cleaned list immediately (before command processing)
-    if len(raw_lines) != len(raw_lines_original):
-        with open(blocked_file, 'w', encoding='utf-8') as f:
-            for l in raw_lines:
-                f.write(f"{l}\n")
-
     if not raw_lines:
         return
 
@@ -1024,16 +1320,14 @@ def process_blocked_users_commands():
     keep_plain = []  # lines to keep as-is (no command flags, already cleaned)
     commands_found = False
 
-    for line in raw_lines:
+    for username, line in dedup_dict.items():
         if '---ub' in line:
-            username = extract_username_from_line(line)
             note = extract_notes_from_line(line)
             if username:
                 to_unblock[username] = note
                 commands_found = True
         elif '---d' in line:
             # Delete user entirely
-            username = extract_username_from_line(line)
             if username:
                 to_delete.add(username)
                 commands_found = True
@@ -1041,6 +1335,10 @@ def process_blocked_users_commands():
             keep_plain.append(line)  # keep full line (could contain note)
 
     if not commands_found:
+        # Only persist the de-duplicated list; with commands the file is rebuilt below anyway
+        if len(raw_lines) != len(raw_lines_original):
+            with open(blocked_file, 'w', encoding='utf-8') as f:
+                f.write(''.join(f"{l}\n" for l in raw_lines))
         return  # nothing to do
 
     # Load current users list
@@ -1048,13 +1346,11 @@ def process_blocked_users_commands():
     updated_users = []
     modified_users = set()
 
-    existing_usernames = [extract_username_from_line(u) for u in users]
-
     for user_line in users:
         uname = extract_username_from_line(user_line)
         if uname in to_unblock:
             # Remove block symbol if present and update note if provided
-            base = user_line.lstrip(BLOCKED_SYMBOL).lstrip()
+            base = user_line.removeprefix(BLOCKED_SYMBOL).lstrip()
             # Remove old note
             base_without_note = remove_notes_from_line(base)
             new_note_raw = to_unblock.get(uname, '')
@@ -1081,88 +1377,66 @@ def process_blocked_users_commands():
             updated_users.append(user_line)
 
     # Move modified users to top for visibility
-    final_users = updated_users.copy()
-    for uname in modified_users:
-        final_users = move_user_to_top(final_users, uname)
+    final_users = move_users_to_top(updated_users, modified_users)
 
     # Persist changes
     save_user_state(final_users)  # update state snapshot
-    backup_user_list()
-    for uname in modified_users:
-        backup_user(uname)
+    backup_users(modified_users)
     save_user_list(final_users)
 
-    # Re-write blocked_users.txt based on CURRENT state of user_list.txt
-    # Only include users that are actually blocked (have 🚫 symbol)
-    # Exclude users that were unblocked or deleted
-    new_block_list = []
-    
-    # Rebuild blocked_users.txt from final user_list.txt state
-    # (after processing unblocks/deletes and moving users to top)
-    for user_line in final_users:
-        if user_line.startswith(BLOCKED_SYMBOL):
-            # This user is still blocked, add to blocked_users.txt
-            entry = user_line.lstrip(BLOCKED_SYMBOL).lstrip()
-            uname = extract_username_from_line(entry)
-            # Only add if not in to_delete (shouldn't happen, but safety check)
-            if uname not in to_delete:
-                new_block_list.append(entry)
-    
-    # Write the updated blocked_users.txt
-    with open(blocked_file, 'w', encoding='utf-8') as f:
-        for entry in new_block_list:
-            f.write(f"{entry}\n")
+    # Re-write blocked_users.txt from the final user list (unblocked and deleted users are gone)
+    write_blocked_users_file(final_users)
 
     # Remove subscription files for deleted users
     if to_delete:
         subscription_dir = 'subscriptions'
         for uname in to_delete:
-            sub_file = os.path.join(subscription_dir, f"{uname}.txt")
-            if os.path.exists(sub_file):
-                os.remove(sub_file)
+            try:
+                os.remove(os.path.join(subscription_dir, f"{uname}.txt"))
+            except FileNotFoundError:
+                pass
 
 def check_expired_users():
+    reset_iran_time()
     users = load_user_list()
-    updated_users = []
-    expired_users = []
+    # Expired users are blocked and moved to the top (latest first) in the same pass
+    expired_lines = []
+    other_lines = []
     for user_line in users:
-        username = extract_username_from_line(user_line)
         is_expired, expiry_time = check_expiry_datetime(user_line)
         if is_expired and not user_line.startswith(BLOCKED_SYMBOL):
-            expired_users.append(username)
+            username = extract_username_from_line(user_line)
             log_user_history(username, "expired", expiry_time.strftime("%Y-%m-%d %H:%M") if expiry_time else "")
-            updated_line = f"{BLOCKED_SYMBOL}{user_line}"
-            updated_users.append(updated_line)
+            expired_lines.append(f"{BLOCKED_SYMBOL}{user_line}")
         else:
-            updated_users.append(user_line)
-    if expired_users:
-        # Move expired users to the top
-        final_users = updated_users.copy()
-        for username in expired_users:
-            final_users = move_user_to_top(final_users, username)
+            other_lines.append(user_line)
+    if expired_lines:
+        final_users = expired_lines[::-1] + other_lines
         
-        # Create a backup when users expire
-        backup_user_list()
+        # save_user_list creates a backup when users expire
         save_user_list(final_users)
-        existing_blocked = get_blocked_users()
-        all_blocked = existing_blocked.union(set(expired_users))
-        with open('blocked_users.txt', 'w', encoding='utf-8') as f:
-            for user in all_blocked:
-                f.write(f"{user}\n")
+        write_blocked_users_file(final_users)
+
+def list_subscription_files(subscription_dir):
+    """Return the names of the .txt subscription files in subscription_dir.
+    Symlinks are skipped so the check needs no stat call beyond the directory read."""
+    with os.scandir(subscription_dir) as it:
+        return [entry.name for entry in it if entry.name.endswith('.txt') and entry.is_file(follow_symlinks=False)]
 
 def discover_new_subscriptions():
     subscription_dir = 'subscriptions'
     if not os.path.exists(subscription_dir):
         return
-    subscription_files = [f for f in os.listdir(subscription_dir) if f.endswith('.txt')]
+    subscription_files = list_subscription_files(subscription_dir)
     existing_users = load_user_list()
     # Extract just the usernames for comparison
-    existing_usernames = [extract_username_from_line(user) for user in existing_users]
+    existing_usernames = {extract_username_from_line(user) for user in existing_users}
     
-    # Debug print
     print(f"Discovering new subscriptions")
-    print(f"Subscription files: {subscription_files}")
-    print(f"Existing usernames: {existing_usernames}")
+    # Dumping both lists is only useful when debugging and slow for many subscriptions
+    if DEBUG:
+        print(f"Subscription files: {subscription_files}")
+        print(f"Existing usernames: {sorted(existing_usernames)}")
     
     for filename in subscription_files:
         base_username = filename[:-4]  # Remove .txt extension
@@ -1172,48 +1446,61 @@ def discover_new_subscriptions():
             # Username doesn't exist, add it normally
             print(f"Adding new subscription: {base_username}")
             add_user_to_list(base_username)
-        else:
+        elif DEBUG:
             print(f"Subscription {base_username} already exists, skipping")
         # If the username already exists, we don't need to do anything
         # The add_user_to_list function handles generating unique usernames if needed
 
+# VMess config keys compared for duplicate detection
+VMESS_KEYS = ('v', 'ps', 'add', 'port', 'id', 'aid', 'net', 'type', 'host', 'path', 'tls')
+# VMess values normalized to strings so numeric and string forms compare equal
+VMESS_STR_KEYS = frozenset(('port', 'aid'))
+
 def normalize_vmess_url(server_line):
     try:
         base64_part = server_line[8:].split('#')[0]
-        decoded = base64.b64decode(base64_part).decode('utf-8')
-        config = json.loads(decoded)
-        standard_keys = ['v', 'ps', 'add', 'port', 'id', 'aid', 'net', 'type', 'host', 'path', 'tls']
+        decoded = base64.b64decode(base64_part)
+        config = orjson.loads(decoded) if orjson is not None else json.loads(decoded.decode('utf-8'))
         normalized_config = {}
-        for key in standard_keys:
+        for key in VMESS_KEYS:
             val = config.get(key, '')
-            if key in ['port', 'aid'] and val != '':
+            if key in VMESS_STR_KEYS and val != '':
                 val = str(val)
             if val is None:
                 val = ''
             normalized_config[key] = val
-        sorted_config = {k: normalized_config[k] for k in sorted(normalized_config)}
-        normalized_json = json.dumps(sorted_config, separators=(',', ':'))
-        normalized_base64 = base64.b64encode(normalized_json.encode('utf-8')).decode('utf-8')
+        # Only used as a comparison key, so orjson's UTF-8 output needs no json.dumps parity
+        if orjson is not None:
+            normalized_json = orjson.dumps(normalized_config, option=orjson.OPT_SORT_KEYS)
+        else:
+            normalized_json = json.dumps(normalized_config, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        normalized_base64 = base64.b64encode(normalized_json).decode('utf-8')
         return f"vmess://{normalized_base64}"
     except Exception:
         return server_line
 
+# Cached: sized for a full fetch of every source, so dedup and list moves never re-normalize
+@lru_cache(maxsize=65536)
 def extract_server_config(server_line):
     """Extract normalized server config for duplicate detection.
-    Supports: vless, vmess, trojan, ss, hysteria, hysteria2"""
+    Supports: vless, vmess, trojan, ss, hysteria, hysteria2
+    Cached because the same server line is compared many times per run."""
     try:
         server_line = server_line.strip()
         if server_line.startswith('vmess://'):
             return normalize_vmess_url(server_line)
-        elif server_line.startswith(('vless://', 'trojan://', 'ss://', 'hysteria://', 'hysteria2://')):
+        elif server_line.startswith(URL_SCHEMES):
             url_part = server_line.split('#')[0]
             parsed = urlparse(url_part)
             scheme = parsed.scheme.lower()
             netloc = parsed.netloc.lower()
             path = parsed.path
-            query_params = parse_qsl(parsed.query, keep_blank_values=True)
-            query_params.sort()
-            query = urlencode(query_params, doseq=True)
+            # Sort query params so their order doesn't matter; most URLs have none
+            query = ''
+            if parsed.query:
+                query_params = parse_qsl(parsed.query, keep_blank_values=True)
+                query_params.sort()
+                query = urlencode(query_params, doseq=True)
             normalized = urlunparse((scheme, netloc, path, '', query, ''))
             return normalized
         else:
@@ -1226,6 +1513,10 @@ def extract_server_config(server_line):
 NON_WORKING_FILE = 'non_working.txt'
 MAIN_FILE = 'servers.txt'
 CONTROL_PANEL_FILE = 'control_panel.txt'
+# Active-server markers stripped from control panel lines in a single pass
+_ACTIVE_MARK_RE = re.compile(r'✓|---on|---ON')
+# Deletes the tick alone, for lines already known to carry no ---on marker
+_TICK_TRANS = str.maketrans('', '', '✓')
 HISTORY_FILE = 'server_history.txt'
 USER_HISTORY_FILE = 'user_history.txt'
 QUARANTINE_DAYS = 3
@@ -1234,46 +1525,81 @@ BACKUP_DAYS = 10  # Keep backups for 10 days
 SERVER_HISTORY_DAYS = 10  # Keep server history for 10 days
 # Timeout (seconds) for TCP health-check
 VALIDATION_TIMEOUT = 3
+# Threads used for TCP health-checks (each waits at most VALIDATION_TIMEOUT)
+VALIDATION_WORKERS = 32
+# Threads used to write subscription files
+SUBSCRIPTION_WRITE_WORKERS = 16
+# SO_LINGER on, 0 s timeout: health-check sockets close with an RST instead of entering TIME_WAIT
+_LINGER_RESET = struct.pack('ii', 1, 0)
 
 # Fast-run flag: when set, the script skips heavy maintenance (health-checks, flag decoration, etc.)
 FAST_RUN = os.getenv("FAST_RUN", "0") == "1"
 
+# Trailing "| YYYY-MM-DD HH:MM" timestamp of a history entry
+_HISTORY_DATE_RE = re.compile(r' \| (\d{4}-\d{2}-\d{2}) \d{2}:\d{2}\s*$')
+
+def trim_history(entries, cutoff_str):
+    """Return the entries dated on or after cutoff_str.
+    History files are written newest-first, so reading stops at the first stale entry."""
+    recent = []
+    for entry in entries:
+        if not entry.strip():
+            continue
+        match = _HISTORY_DATE_RE.search(entry)
+        if match and match.group(1) < cutoff_str:
+            break
+        # Keep line if we can't parse the date
+        recent.append(entry)
+    return recent
+
+# (file identity, username -> first non-empty notes) of the last user_list.txt read by get_user_notes
+_user_notes_cache = (None, {})
+
+def get_user_notes():
+    """Map each username in user_list.txt to the notes of its first line that has any.
+    The file is only re-read when it changed on disk since the previous call."""
+    global _user_notes_cache
+    try:
+        st = os.stat(USER_LIST_FILE)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return {}
+    if _user_notes_cache[0] != key:
+        notes_by_user = {}
+        for line in load_user_list():
+            username = extract_username_from_line(line)
+            if username not in notes_by_user:
+                line_notes = extract_notes_from_line(line)
+                if line_notes:
+                    notes_by_user[username] = line_notes
+        _user_notes_cache = (key, notes_by_user)
+    return _user_notes_cache[1]
+
+def iter_history_entries(f, chunk_size=1 << 16):
+    """Yield the blank-line separated entries of a user history file (each with its
+    trailing blank line) while reading it, so trim_history can stop at the first stale one."""
+    pending = ''
+    for chunk in iter(lambda: f.read(chunk_size), ''):
+        pending += chunk
+        *entries, pending = pending.split('\n\n')
+        for entry in entries:
+            yield entry + '\n\n'
+    yield pending + '\n\n'
+
+# History entries logged during this run, oldest first; flush_history() writes them
+_pending_history = []
+_pending_user_history = []
+
 def log_history(server, action):
-    iran_time = get_iran_time()
-    now = iran_time.strftime("%Y-%m-%d %H:%M")
-    new_entry = f"{server} | {action} | {now}\n"
-    existing_lines = []
-    if os.path.exists(HISTORY_FILE):
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            existing_lines = f.readlines()
-    
-    # Filter entries older than SERVER_HISTORY_DAYS days
-    if existing_lines:
-        filtered_lines = []
-        cutoff_date = iran_time - datetime.timedelta(days=SERVER_HISTORY_DAYS)
-        cutoff_str = cutoff_date.strftime("%Y-%m-%d")
-        
-        for line in existing_lines:
-            try:
-                parts = line.strip().split(' | ')
-                if len(parts) >= 3:
-                    entry_date = parts[2].split()[0]  # Get just the date part
-                    if entry_date >= cutoff_str:
-                        filtered_lines.append(line)
-            except:
-                # Keep line if we can't parse the date
-                filtered_lines.append(line)
-                
-        existing_lines = filtered_lines
-        
-    with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-        # Write new entry first, followed by existing entries
-        f.write(new_entry + ''.join(existing_lines))
+    now = get_iran_timestamp()
+    _pending_history.append(f"{server} | {action} | {now}\n")
 
-def log_user_history(username, action, details="", max_days=USER_HISTORY_DAYS):
+def log_user_history(username, action, details="", notes=None):
     """
     Log user-related actions with newest entries at the top
     Actions: added, removed, blocked, unblocked, renamed, expiry_set, expired
+    Pass `notes` when the caller already knows them to skip the user_list lookup.
+    Entries are buffered until flush_history().
     """
     # If details starts with #, it's likely a note directly from user_data
     if details.startswith('#'):
@@ -1283,15 +1609,11 @@ def log_user_history(username, action, details="", max_days=USER_HISTORY_DAYS):
         details = f"[Note: {note_content}]"
     # Check if notes are already included in details in our standard format
     elif "[Note:" not in details:
-        # Only lookup notes in user_list if not already in details
-        notes = ""
-        users = load_user_list()
-        for line in users:
-            if username == extract_username_from_line(line):
-                line_notes = extract_notes_from_line(line)
-                if line_notes:
-                    notes = f"[Note: {line_notes}]"
-                    break
+        # Only lookup notes in user_list if not already in details or passed in
+        if notes is None:
+            notes = get_user_notes().get(username, "")
+        if notes:
+            notes = f"[Note: {notes}]"
 
         # Append notes to details if available
         if notes and details:
@@ -1299,62 +1621,55 @@ def log_user_history(username, action, details="", max_days=USER_HISTORY_DAYS):
         elif notes:
             details = notes
 
+    now = get_iran_timestamp()
+    _pending_user_history.append(f"{username} | {action} | {details} | {now}\n\n")
+
+def flush_history():
+    """Write buffered history entries to the top of the history files in one rewrite each,
+    dropping entries older than SERVER_HISTORY_DAYS / USER_HISTORY_DAYS."""
     iran_time = get_iran_time()
-    now = iran_time.strftime("%Y-%m-%d %H:%M")
-    new_entry = f"{username} | {action} | {details} | {now}\n\n"
-    
-    # Read existing entries
-    existing_lines = []
-    if os.path.exists(USER_HISTORY_FILE):
-        with open(USER_HISTORY_FILE, 'r', encoding='utf-8') as f:
-            content = f.read()
-            # Split by double newlines (empty line between entries)
-            entries = content.split('\n\n')
-            # Filter out empty entries
-            existing_lines = [entry + '\n\n' for entry in entries if entry.strip()]
-    
-    # Remove entries older than max_days
-    if existing_lines:
-        filtered_lines = []
-        cutoff_date = iran_time - datetime.timedelta(days=max_days)
-        cutoff_str = cutoff_date.strftime("%Y-%m-%d")
-        
-        for line in existing_lines:
-            try:
-                entry = line.strip()
-                parts = entry.split(' | ')
-                if len(parts) >= 4:
-                    entry_date = parts[3].split()[0]  # Get just the date part
-                    if entry_date >= cutoff_str:
-                        filtered_lines.append(line)
-            except:
-                # Keep line if we can't parse the date
-                filtered_lines.append(line)
-                
-        existing_lines = filtered_lines
-    
-    # Write the log with new entry at the top
-    with open(USER_HISTORY_FILE, 'w', encoding='utf-8') as f:
-        f.write(new_entry + ''.join(existing_lines).rstrip('\n') + '\n')
+    if _pending_history:
+        existing_lines = []
+        if os.path.exists(HISTORY_FILE):
+            cutoff_str = (iran_time - datetime.timedelta(days=SERVER_HISTORY_DAYS)).strftime("%Y-%m-%d")
+            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
+                existing_lines = trim_history(f, cutoff_str)
+        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
+            # Write new entries first (newest on top), followed by existing entries
+            f.write(''.join(reversed(_pending_history)) + ''.join(existing_lines))
+        _pending_history.clear()
+
+    if _pending_user_history:
+        existing_lines = []
+        if os.path.exists(USER_HISTORY_FILE):
+            cutoff_str = (iran_time - datetime.timedelta(days=USER_HISTORY_DAYS)).strftime("%Y-%m-%d")
+            with open(USER_HISTORY_FILE, 'r', encoding='utf-8') as f:
+                existing_lines = trim_history(iter_history_entries(f), cutoff_str)
+        with open(USER_HISTORY_FILE, 'w', encoding='utf-8') as f:
+            f.write((''.join(reversed(_pending_user_history)) + ''.join(existing_lines)).rstrip('\n') + '\n')
+        _pending_user_history.clear()
+
+# Safety net so buffered entries are not lost if the run stops early
+atexit.register(flush_history)
 
 # === REMOVE DUPLICATES WITH LOGGING ===
 
 def remove_duplicates(servers):
     """Remove duplicate servers and log which file it's happening in."""
-    seen_configs = {}
+    seen_configs = set()
     unique_servers = []
     active_file = get_active_server_file()
     for server in servers:
-        if not server.strip():
+        stripped = server.strip()
+        if not stripped:
             continue
-        config_key = extract_server_config(server)
+        config_key = extract_server_config(stripped)
         if config_key in seen_configs:
             # Log duplicate removal with file info
             log_history(server, f"removed_duplicate(from:{active_file})")
             continue
-        else:
-            seen_configs[config_key] = server.strip()
-            unique_servers.append(server.strip())
+        seen_configs.add(config_key)
+        unique_servers.append(stripped)
     return unique_servers
 
 def parse_non_working_line(line):
@@ -1382,26 +1697,27 @@ def parse_non_working_line(line):
 
 # === Control Panel Functions ===
 
+@lru_cache(maxsize=1)
 def get_active_server_file():
-    """Read control_panel.txt and return the active server file name."""
+    """Read control_panel.txt and return the active server file name.
+    Cached for the run; process_control_panel clears the cache after rewriting the file."""
     if not os.path.exists(CONTROL_PANEL_FILE):
         # Default to servers.txt if control_panel.txt doesn't exist
         return MAIN_FILE
     
-    with open(CONTROL_PANEL_FILE, 'r', encoding='utf-8') as f:
-        lines = [line.strip() for line in f if line.strip()]
+    lines = read_stripped_lines(CONTROL_PANEL_FILE)
     
     for line in lines:
         # Check if line starts with tick emoji (active server)
         if line.startswith('✓'):
             # Extract server file name (remove tick and any whitespace)
-            server_file = line.replace('✓', '').strip()
+            server_file = line.translate(_TICK_TRANS).strip()
             if server_file:
                 return server_file
         # Also check for ---on marker (backward compatibility)
         elif '---on' in line.lower():
             # Extract server file name (remove ---on and any whitespace)
-            server_file = line.replace('---on', '').replace('---ON', '').replace('✓', '').strip()
+            server_file = _ACTIVE_MARK_RE.sub('', line).strip()
             if server_file:
                 return server_file
     
@@ -1416,47 +1732,42 @@ def process_control_panel():
         # Create default control_panel.txt with servers.txt active
         with open(CONTROL_PANEL_FILE, 'w', encoding='utf-8') as f:
             f.write(f"✓ {MAIN_FILE}\n")
+        get_active_server_file.cache_clear()
         return
     
-    with open(CONTROL_PANEL_FILE, 'r', encoding='utf-8') as f:
-        lines = [line.strip() for line in f if line.strip()]
+    lines = read_stripped_lines(CONTROL_PANEL_FILE)
     
     # Track seen server files to prevent duplicates
     seen_servers = set()
-    active_server = None  # Track which server should be active
     updated_lines = []
     any_changes = False
     
-    # First pass: identify which server should be active (prioritize ---on over existing ticks)
-    for line in lines:
-        clean_line = line.replace('✓', '').replace('---on', '').replace('---ON', '').strip()
-        if not clean_line:
-            continue
-        
-        # If this line has ---on marker, this is the server user wants to activate
-        if '---on' in line.lower():
-            active_server = clean_line
-            any_changes = True
-            break  # ---on takes priority, stop searching
-    
-    # If no ---on found, check for existing tick
-    if active_server is None:
-        for line in lines:
-            if line.startswith('✓'):
-                clean_line = line.replace('✓', '').strip()
-                if clean_line:
-                    active_server = clean_line
-                    break
-    
-    # Second pass: build the output lines
+    # Single pass: clean every line once and note the first ---on and first tick
+    normalized = []
+    on_server = None
+    tick_server = None
     for line in lines:
         # Remove tick emoji and ---on markers to get clean server name
-        clean_line = line.replace('✓', '').replace('---on', '').replace('---ON', '').strip()
-        
+        clean_line = _ACTIVE_MARK_RE.sub('', line).strip()
         # Skip empty lines
         if not clean_line:
             continue
-        
+        normalized.append((line, clean_line))
+        if '---on' in line.lower():
+            if on_server is None:
+                on_server = clean_line
+        elif tick_server is None and line.startswith('✓'):
+            tick_server = clean_line
+    
+    # ---on takes priority over an existing tick
+    if on_server is not None:
+        active_server = on_server
+        any_changes = True
+    else:
+        active_server = tick_server
+    
+    # Build the output lines
+    for line, clean_line in normalized:
         # Check for duplicates
         if clean_line in seen_servers:
             any_changes = True
@@ -1478,7 +1789,7 @@ def process_control_panel():
     
     # If no active server was found, activate the first one
     if active_server is None and updated_lines:
-        first_line = updated_lines[0].replace('✓', '').replace('---on', '').replace('---ON', '').strip()
+        first_line = _ACTIVE_MARK_RE.sub('', updated_lines[0]).strip()
         updated_lines[0] = f"✓ {first_line}"
         any_changes = True
         active_server = first_line
@@ -1491,8 +1802,8 @@ def process_control_panel():
     
     # Always write back to ensure correct format
     with open(CONTROL_PANEL_FILE, 'w', encoding='utf-8') as f:
-        for line in updated_lines:
-            f.write(line + '\n')
+        f.write(''.join(line + '\n' for line in updated_lines))
+    get_active_server_file.cache_clear()
     
     if any_changes:
         try:
@@ -1512,8 +1823,7 @@ def load_main_servers():
     if not os.path.exists(active_file):
         return []
     
-    with open(active_file, 'r', encoding='utf-8') as f:
-        servers = [line.strip() for line in f if line.strip()]
+    servers = read_stripped_lines(active_file)
     
     try:
         print(f"📡 Loading servers from: {active_file} ({len(servers)} servers)")
@@ -1523,24 +1833,18 @@ def load_main_servers():
 
 def save_main_servers(servers):
     """Save servers to the active server file specified in control_panel.txt."""
-    active_file = get_active_server_file()
-    with open(active_file, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(servers) + '\n')
+    write_file_atomic(get_active_server_file(), '\n'.join(servers) + '\n')
 
 def load_non_working():
     if not os.path.exists(NON_WORKING_FILE):
         return []
-    with open(NON_WORKING_FILE, 'r', encoding='utf-8') as f:
-        return [line.strip() for line in f if line.strip()]
+    return read_stripped_lines(NON_WORKING_FILE)
 
 def save_non_working(servers):
-    with open(NON_WORKING_FILE, 'w', encoding='utf-8') as f:
-        if servers:
-            f.write('\n'.join(servers) + '\n')
-        else:
-            f.truncate(0)
+    write_file_atomic(NON_WORKING_FILE, '\n'.join(servers) + '\n' if servers else '')
 
 def cleanup_non_working():
+    reset_iran_time()
     today = get_iran_time()
     non_working_lines = load_non_working()
     keep_non_working = []
@@ -1556,25 +1860,37 @@ def cleanup_non_working():
         else:
             keep_non_working.append(line)
     save_non_working(keep_non_working)
+    flush_history()
 
 def move_server_to_non_working(server_line):
     """Move a server to non_working.txt and track which server file it came from."""
-    iran_time = get_iran_time()
-    now_str = iran_time.strftime("%Y-%m-%d %H:%M")
+    move_servers_to_non_working([server_line])
+
+def move_servers_to_non_working(server_lines):
+    """Move several servers to non_working.txt with a single read and write."""
+    now_str = get_iran_timestamp()
     # Track source file: format: server | source_file | date
     source_file = get_active_server_file()
-    entry = f"{server_line} | {source_file} | {now_str}"
     non_working = load_non_working()
-    # Check if server already exists (comparing server part only)
-    server_part = entry.split(' | ')[0]
-    if not any(server_part in line.split(' | ')[0] for line in non_working):
-        # Add new non-working servers to the top of the list
-        non_working.insert(0, entry)
-        save_non_working(non_working)
+    # Server part of every quarantined entry, for exact duplicate checks
+    known_servers = {line.split(' | ', 1)[0] for line in non_working}
+    # New entries go on top, the most recently moved first, as with one-at-a-time moves
+    updated = deque(non_working)
+    for server_line in server_lines:
+        if server_line in known_servers:
+            continue
+        known_servers.add(server_line)
+        updated.appendleft(f"{server_line} | {source_file} | {now_str}")
         log_history(server_line, f"moved_to_non_working(from:{source_file})")
+    if len(updated) != len(non_working):
+        save_non_working(list(updated))
 
 def move_server_to_main(server_line, target_file=None):
     """Move a server back to a server file. If target_file is None, uses currently active file."""
+    move_servers_to_main([server_line], target_file)
+
+def move_servers_to_main(server_lines, target_file=None):
+    """Move several servers back to one server file with a single read and write."""
     if target_file is None:
         target_file = get_active_server_file()
     
@@ -1582,120 +1898,139 @@ def move_server_to_main(server_line, target_file=None):
     if not os.path.exists(target_file):
         return
     
-    with open(target_file, 'r', encoding='utf-8') as f:
-        main_servers = [line.strip() for line in f if line.strip()]
+    main_servers = read_stripped_lines(target_file)
     
-    # Check for duplicates
-    normalized_new = extract_server_config(server_line)
-    for existing in main_servers:
-        if extract_server_config(existing) == normalized_new:
-            return
+    # Check for duplicates against the file and against each other
+    known_configs = {extract_server_config(existing) for existing in main_servers}
+    added = False
+    for server_line in server_lines:
+        config = extract_server_config(server_line)
+        if config in known_configs:
+            continue
+        known_configs.add(config)
+        main_servers.append(server_line)
+        added = True
+        log_history(server_line, f"moved_to_main({target_file})")
     
-    main_servers.append(server_line)
-    with open(target_file, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(main_servers) + '\n')
-    log_history(server_line, f"moved_to_main({target_file})")
+    if added:
+        write_file_atomic(target_file, '\n'.join(main_servers) + '\n')
 
 def process_non_working_recovery():
     """Recover servers from non_working.txt back to their original server files."""
+    reset_iran_time()
     non_working_lines = load_non_working()
     keep_non_working = []
-    for line in non_working_lines:
-        server, dt, source_file = parse_non_working_line(line)
+    # Recovered servers grouped by target file (None = active file), written once per file
+    recoveries = {}
+    parsed_lines = [(line, *parse_non_working_line(line)) for line in non_working_lines]
+    # Test all quarantined servers at once (each distinct server once) to see which are working again
+    candidates = list(dict.fromkeys(server for _, server, dt, _ in parsed_lines if server and dt))
+    working = dict(zip(candidates, validate_servers(candidates)))
+    for line, server, dt, source_file in parsed_lines:
         if not server or not dt:
             keep_non_working.append(line)
             continue
         
-        # Test if server is working again
-        if validate_server(server):
+        if working[server]:
             # Recover to original source file - each server goes back to where it came from
             # Example: server from servers1.txt goes back to servers1.txt, not servers.txt
             target_file = source_file if source_file and os.path.exists(source_file) else None
-            move_server_to_main(server, target_file)
+            recoveries.setdefault(target_file, []).append(server)
             source_info = f"from:{source_file}," if source_file else ""
             log_history(server, f"recovered_to_main({source_info}to:{target_file or 'active'})")
         else:
             keep_non_working.append(line)
+    for target_file, servers in recoveries.items():
+        move_servers_to_main(servers, target_file)
     save_non_working(keep_non_working)
+    flush_history()
+
+# Substrings (matched case-insensitively) that mark a placeholder/fake server
+FAKE_INDICATORS = (
+    "127.0.0.1",
+    "localhost",
+    "fake",
+    "Fake Server",
+    "fakepas",
+    "12345678-1234-1234-1234-123456789",
+    "YWVzLTI1Ni1nY206ZmFrZXBhc3N3b3Jk"
+)
+_FAKE_RE = re.compile('|'.join(map(re.escape, FAKE_INDICATORS)), re.IGNORECASE)
 
 def is_fake_server(server_line):
-    fake_indicators = [
-        "127.0.0.1",
-        "localhost",
-        "fake",
-        "Fake Server",
-        "fakepas",
-        "12345678-1234-1234-1234-123456789",
-        "YWVzLTI1Ni1nY206ZmFrZXBhc3N3b3Jk"
-    ]
-    server_lower = server_line.lower()
-    for indicator in fake_indicators:
-        if indicator.lower() in server_lower:
-            return True
-    return False
-
-def validate_server(server_line):
-    """Validate server connectivity by testing TCP connection.
-    Supports: vless, vmess, trojan, ss, hysteria, hysteria2"""
+    return _FAKE_RE.search(server_line) is not None
+
+# Default port per URL-style scheme when the URL doesn't specify one
+DEFAULT_PORTS = {'vless': 443, 'trojan': 443, 'ss': 8388, 'hysteria': 443, 'hysteria2': 443}
+
+@lru_cache(maxsize=8192)
+def get_server_endpoint(server_line):
+    """Return (hostname, port) for a server line, or (None, None) if it can't be parsed.
+    Supports: vless, vmess, trojan, ss, hysteria, hysteria2
+    Cached so re-probing the same server doesn't re-decode it."""
+    scheme, sep, _ = server_line.partition('://')
+    if not sep or (scheme != 'vmess' and scheme not in DEFAULT_PORTS):
+        return None, None
     try:
-        hostname = None
-        port = None
-        if server_line.startswith('vless://'):
-            url_part = server_line.split('#')[0]
-            parsed = urlparse(url_part)
-            hostname = parsed.hostname
-            port = parsed.port or 443
-        elif server_line.startswith('vmess://'):
+        if scheme == 'vmess':
             config_data = base64.b64decode(server_line[8:]).decode('utf-8')
             config = json.loads(config_data)
             hostname = config.get('add')
             port = int(config.get('port', 443))
-        elif server_line.startswith('ss://'):
-            url_part = server_line.split('#')[0]
-            parsed = urlparse(url_part)
-            hostname = parsed.hostname
-            port = parsed.port or 8388
-        elif server_line.startswith('trojan://'):
-            url_part = server_line.split('#')[0]
-            parsed = urlparse(url_part)
-            hostname = parsed.hostname
-            port = parsed.port or 443
-        elif server_line.startswith(('hysteria://', 'hysteria2://')):
-            url_part = server_line.split('#')[0]
-            parsed = urlparse(url_part)
+        else:
+            parsed = urlparse(server_line.split('#')[0])
             hostname = parsed.hostname
-            port = parsed.port or 443
-        if hostname and port:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(VALIDATION_TIMEOUT)
-            result = sock.connect_ex((hostname, port))
-            sock.close()
-            return result == 0
-    except Exception:
+            port = parsed.port or DEFAULT_PORTS[scheme]
+    except (ValueError, TypeError, AttributeError):
+        # Malformed base64/JSON/port, or a vmess payload that isn't an object
+        return None, None
+    if hostname and port:
+        return hostname, port
+    return None, None
+
+def validate_server(server_line):
+    """Validate server connectivity by testing TCP connection."""
+    hostname, port = get_server_endpoint(server_line)
+    if not hostname:
+        return False
+    try:
+        # create_connection tries every address getaddrinfo returns, so IPv6-only hosts work too
+        sock = socket.create_connection((hostname, port), timeout=VALIDATION_TIMEOUT)
+    except OSError:
         return False
-    return False
+    close_probe_socket(sock)
+    return True
+
+def close_probe_socket(sock):
+    """Close a health-check socket with an RST (SO_LINGER 0) so it skips TIME_WAIT
+    and doesn't tie up an ephemeral port."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, _LINGER_RESET)
+    except OSError:
+        pass
+    sock.close()
+
+def validate_servers(server_lines):
+    """Validate many servers in parallel threads; returns a list of bools in input order."""
+    if not server_lines:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(VALIDATION_WORKERS, len(server_lines))) as executor:
+        return list(executor.map(validate_server, server_lines))
 
 def get_blocked_users():
-    """Return a set of usernames that are currently blocked.
+    """Return a frozenset of usernames that are currently blocked.
 
     The blocked_users.txt file may contain extra notes after the username
     (e.g. "john #note | blocked 2025-07-20").  We must therefore extract
     just the username portion on each line so the lookup in
     update_all_subscriptions() is reliable.
     """
-    blocked_users = set()
     try:
-        with open('blocked_users.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                username = extract_username_from_line(line)
-                if username:
-                    blocked_users.add(username)
+        lines = read_stripped_lines('blocked_users.txt')
     except FileNotFoundError:
-        pass
-    return blocked_users
+        return frozenset()
+    usernames = (extract_username_from_line(line) for line in lines if not line.startswith('#'))
+    return frozenset(username for username in usernames if username)
 
 def should_block_user(username, blocked_users):
     return username in blocked_users
@@ -1711,6 +2046,25 @@ def distribute_servers(servers, username):
 
 # === User List Backup Functions ===
 
+# Human-readable "_YYYY-MM-DD_HH-MM[-SS]" date at the end of a backup file name
+_BACKUP_DATE_RE = re.compile(r'_(20\d{2}-\d{2}-\d{2})_\d{2}-\d{2}(?:-\d{2})?$')
+
+def prune_backups(backup_files, iran_time):
+    """Delete backups dated more than BACKUP_DAYS days ago.
+    Files are checked oldest-first, stopping at the first one that is kept."""
+    cutoff_day = (iran_time - datetime.timedelta(days=BACKUP_DAYS)).strftime("%Y-%m-%d")
+    dated = []
+    for backup_file in backup_files:
+        match = _BACKUP_DATE_RE.search(backup_file.stem)
+        # Skip files with invalid naming format
+        if match:
+            dated.append((match.group(1), backup_file))
+    dated.sort()
+    for day, backup_file in dated:
+        if day > cutoff_day:
+            break
+        backup_file.unlink()
+
 def backup_user_list():
     """Create a dated backup of user_list.txt in a backups folder"""
     if not os.path.exists(USER_LIST_FILE):
@@ -1720,6 +2074,13 @@ def backup_user_list():
     backup_dir = Path('backups')
     backup_dir.mkdir(exist_ok=True)
     
+    # Skip the copy when user_list.txt is identical to the newest backup.
+    # The reversed timestamp makes the newest backup sort first by name
+    # (mtimes are not reliable: copy2 keeps the source's, and checkouts reset them)
+    newest_backup = min(backup_dir.glob("user_list_*.txt"), key=lambda p: p.name, default=None)
+    if newest_backup and filecmp.cmp(USER_LIST_FILE, newest_backup, shallow=False):
+        return True
+    
     # Generate backup filename with timestamp
     iran_time = get_iran_time()
     # Use date format that sorts in reverse chronological order
@@ -1730,45 +2091,13 @@ def backup_user_list():
     backup_filename = backup_dir / f"user_list_{timestamp}_{display_timestamp}.txt"
     
     try:
-        # Copy the user list to the backup file
+        # A real copy, so the backup never shares an inode with the live file
         shutil.copy2(USER_LIST_FILE, backup_filename)
         
-        # Cleanup old backups (keep those from last BACKUP_DAYS days)
-        backups = list(backup_dir.glob("user_list_*.txt"))
-        cutoff_date = iran_time - datetime.timedelta(days=BACKUP_DAYS)
-        
-        for backup_file in backups:
-            # Extract date from filename
-            try:
-                # Check if it's our new format with both timestamps
-                if "_20" in backup_file.name:  # Look for original timestamp portion
-                    # Extract the original timestamp part (after the reverse timestamp)
-                    filename_parts = backup_file.name.split('_')
-                    if len(filename_parts) >= 4:  # Should be user_list_REVTS1_REVTS2_ORIGTS1_ORIGTS2.txt
-                        # Try to find the original timestamp part
-                        for i, part in enumerate(filename_parts):
-                            if part.startswith('20'):  # Year starting with 20xx
-                                orig_date_str = part  # This should be the year
-                                if len(filename_parts) > i+1:
-                                    orig_date_str = f"{orig_date_str}-{filename_parts[i+1]}"  # Add month-day
-                                    file_date = datetime.datetime.strptime(orig_date_str, "%Y-%m-%d").replace(tzinfo=IRAN_TZ)
-                                    if file_date < cutoff_date:
-                                        backup_file.unlink()
-                                break
-                else:
-                    # Legacy format is user_list_YYYY-MM-DD_HH-MM-SS.txt
-                    date_str = backup_file.stem.split('_', 1)[1]  # Get YYYY-MM-DD_HH-MM-SS part
-                    date_parts = date_str.split('_')
-                    if len(date_parts) >= 2:
-                        date_str = date_parts[0]  # Get YYYY-MM-DD part
-                        file_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=IRAN_TZ)
-                        if file_date < cutoff_date:
-                            # File is older than BACKUP_DAYS days
-                            backup_file.unlink()
-            except (ValueError, IndexError):
-                # Skip files with invalid naming format
-                continue
-                
+        # user_list backups are never pruned: the old cleanup could not parse these
+        # file names and so never deleted any. Turning it on would remove most of
+        # backups/ in one run, so it is left to a separate, deliberate change.
+
         return True
     except Exception as e:
         print(f"⚠️ Backup failed: {str(e)}")
@@ -1776,81 +2105,64 @@ def backup_user_list():
 
 def backup_user(username):
     """Create a backup of a specific user's entry"""
+    return backup_users([username]) > 0
+
+def backup_users(usernames):
+    """Back up the entries of several users, reading user_list.txt only once.
+    Returns the number of backups written."""
     if not os.path.exists(USER_LIST_FILE):
-        return False
-    
-    # Load the current user list
-    users = load_user_list()
+        return 0
     
-    # Find the user's entry
-    user_entry = None
-    for line in users:
-        if extract_username_from_line(line) == username:
-            user_entry = line
-            break
-    
-    if not user_entry:
-        return False
+    # Current entry of every wanted user (first matching line, as before)
+    wanted = set(usernames)
+    entries = {}
+    for line in load_user_list():
+        username = extract_username_from_line(line)
+        if username in wanted and username not in entries:
+            entries[username] = line
+    if not entries:
+        return 0
     
     # Create user backups directory if it doesn't exist
     user_backup_dir = Path('backups/users')
     user_backup_dir.mkdir(exist_ok=True, parents=True)
     
-    # Create user-specific directory
-    user_dir = user_backup_dir / username
-    user_dir.mkdir(exist_ok=True)
-    
-    # Generate backup filename with timestamp
+    # Generate backup filename timestamp
     iran_time = get_iran_time()
     # Use date format that sorts in reverse chronological order
     timestamp = f"{9999 - iran_time.year:04d}-{12 - iran_time.month:02d}-{31 - iran_time.day:02d}_{23 - iran_time.hour:02d}-{59 - iran_time.minute:02d}"
     # Also include human-readable date in filename
     display_timestamp = iran_time.strftime("%Y-%m-%d_%H-%M")
-    backup_filename = user_dir / f"{username}_{timestamp}_{display_timestamp}.txt"
     
-    try:
-        # Write the user entry to the backup file
-        with open(backup_filename, 'w', encoding='utf-8') as f:
-            f.write(user_entry)
-        
-        # Cleanup old backups (keep those from last BACKUP_DAYS days)
-        backups = list(user_dir.glob(f"{username}_*.txt"))
-        cutoff_date = iran_time - datetime.timedelta(days=BACKUP_DAYS)
-        
-        for backup_file in backups:
-            # Extract date from filename (format: username_TIMESTAMP_DISPLAYTIMESTAMP.txt)
-            # Example: username_7980-12-31_23-59_2024-01-01_12-30.txt
-            # display_timestamp is the last two parts: YYYY-MM-DD_HH-MM
-            try:
-                filename = backup_file.stem  # Get filename without extension
-                parts = filename.split('_')
-                if len(parts) >= 5:
-                    # Display timestamp is the last two parts: YYYY-MM-DD_HH-MM
-                    # Extract date part (second to last): YYYY-MM-DD
-                    date_str = parts[-2]  # YYYY-MM-DD
-                    file_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=IRAN_TZ)
-                    if file_date < cutoff_date:
-                        # File is older than BACKUP_DAYS days
-                        backup_file.unlink()
-            except (ValueError, IndexError):
-                # Skip files with invalid naming format
-                continue
-                
-        return True
-    except Exception as e:
-        print(f"⚠️ User backup failed for {username}: {str(e)}")
-        return False
+    written = 0
+    for username, user_entry in entries.items():
+        try:
+            # Create user-specific directory
+            user_dir = user_backup_dir / username
+            user_dir.mkdir(exist_ok=True)
+            backup_filename = user_dir / f"{username}_{timestamp}_{display_timestamp}.txt"
+            # Write the user entry to the backup file
+            with open(backup_filename, 'w', encoding='utf-8') as f:
+                f.write(user_entry)
+            
+            # Cleanup old backups (keep those from last BACKUP_DAYS days)
+            prune_backups(user_dir.glob(f"{username}_*.txt"), iran_time)
+            written += 1
+        except Exception as e:
+            print(f"⚠️ User backup failed for {username}: {str(e)}")
+    return written
 
 def update_all_subscriptions():
     """Main entry-point. Behaviour depends on FAST_RUN flag."""
+    reset_iran_time()
 
     # Process control panel first to determine which server file is active
     process_control_panel()
 
-    # Always make a backup of user_list before starting
+    # Detect any manual changes since last run. No up-front backup: every step that
+    # rewrites user_list.txt backs up the current version first (save_user_list and
+    # detect_manual_changes), so an unchanged list is never copied.
     if os.path.exists(USER_LIST_FILE):
-        backup_user_list()
-        # Detect any manual changes since last run
         detect_manual_changes()
 
     # Process any commands written directly inside blocked_users.txt FIRST
@@ -1860,22 +2172,18 @@ def update_all_subscriptions():
     # Then process user commands & expiry – they are lightweight
     process_user_commands()
     check_expired_users()
+    # Persist this batch's user history before the slow network work
+    flush_history()
 
     if not FAST_RUN:
-        # Heavy maintenance tasks (hourly / scheduled)
         # Heavy maintenance tasks (hourly / scheduled)
         discover_new_subscriptions()
         
-        # --- Validate main server list and quarantine non-working entries ---
         current_servers = load_main_servers()
-        valid_servers = current_servers
-
-        # Persist the cleaned list
-        save_main_servers(valid_servers)
 
-        # Update remarks & remove duplicates (these are network-bound/CPU heavy)
-        all_servers = update_server_remarks(valid_servers)
-        unique_servers = remove_duplicates(all_servers)
+        # Remove duplicates first so remarks are numbered without gaps and
+        # duplicates are never geolocated (remarks are network-bound)
+        unique_servers = update_server_remarks(remove_duplicates(current_servers))
         save_main_servers(unique_servers)
     else:
         # FAST_RUN → skip all heavy work, use current list as-is
@@ -1884,27 +2192,33 @@ def update_all_subscriptions():
     # Build / update subscription files for every user
     blocked_users = get_blocked_users()
     subscription_dir = 'subscriptions'
-    if not os.path.exists(subscription_dir):
-        os.makedirs(subscription_dir)
+    os.makedirs(subscription_dir, exist_ok=True)
     
     # Load user list to identify which subscriptions are managed by automation
     managed_users = load_user_list()
     managed_usernames = {extract_username_from_line(user) for user in managed_users}
     
     # First, ensure subscription files exist for all managed users
+    subscription_files = list_subscription_files(subscription_dir)
+    existing_files = set(subscription_files)
     for user_line in managed_users:
         username = extract_username_from_line(user_line)
-        subscription_path = os.path.join(subscription_dir, f"{username}.txt")
-        if not os.path.exists(subscription_path):
-            # Create empty subscription file if it doesn't exist
-            with open(subscription_path, 'w', encoding='utf-8') as f:
-                f.write('')
+        filename = f"{username}.txt"
+        if filename not in existing_files:
+            existing_files.add(filename)
+            # No empty placeholder: the write pass below creates the file with its content
+            subscription_files.append(filename)
             try:
                 print(f"Created missing subscription file: {username}.txt")
             except UnicodeEncodeError:
                 print(f"[OK] Created missing subscription file: {username}.txt")
     
-    subscription_files = [f for f in os.listdir(subscription_dir) if f.endswith('.txt')]
+    # Every active user gets the same servers and every blocked user the same fake list,
+    # so encode both subscriptions once
+    active_content = base64.b64encode('\n'.join(unique_servers).encode('utf-8'))
+    blocked_content = base64.b64encode('\n'.join(get_fake_servers()).encode('utf-8'))
+    
+    pending_writes = []
     for filename in subscription_files:
         username = filename[:-4]
         
@@ -1918,14 +2232,16 @@ def update_all_subscriptions():
             continue
         
         if should_block_user(username, blocked_users):
-            servers_for_user = get_fake_servers()
+            encoded_content = blocked_content
         else:
-            servers_for_user = unique_servers
-        subscription_path = os.path.join(subscription_dir, filename)
-        with open(subscription_path, 'w', encoding='utf-8') as f:
-            subscription_content = '\n'.join(servers_for_user)
-            encoded_content = base64.b64encode(subscription_content.encode('utf-8')).decode('utf-8')
-            f.write(encoded_content)
+            encoded_content = active_content
+        pending_writes.append((os.path.join(subscription_dir, filename), encoded_content))
+
+    # Writes are syscall-bound, so overlap them across a few threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SUBSCRIPTION_WRITE_WORKERS) as executor:
+        list(executor.map(lambda write: write_file_if_changed(*write), pending_writes))
+
+    flush_history()
 
 if __name__ == "__main__":
     update_all_subscriptions()